@@ -4,11 +4,35 @@
 # TODO: Check for unknown key!
 
 import re
+import sys
+from functools import partial
 from typing import Dict, Optional, Callable
 
+try:
+    # RE2 matches in linear time, which is worth it for the combined
+    # key patterns.
+    import re2  # type: ignore
+except ImportError:
+    re2 = None
+
 from tree import Tree, Schema, Empty
 
 
+# Maximum number of keys remembered by Type._lookup.
+LOOKUP_CACHE_SIZE = 512  # type: int
+
+
+def key_path(tree, key=None):
+    """
+    Format the path of a key (or of the tree itself) for error messages.
+
+    Only meant to be called once an error is actually raised.
+    """
+    if key is None:
+        return '.'.join(tree._path) or 'ROOT'
+    return '.'.join((*tree._path, key))
+
+
 class ValidationError(RuntimeError):
 
     def __init__(self, path, msg):
@@ -25,8 +49,7 @@ class ValueValidator:
 
     def validate(self, tree, key, value):
         if isinstance(value, Tree):
-            p = '.'.join(tree._path + [key])
-            raise ValidationError(p, 'This key must be a value, not a tree.') from None
+            raise ValidationError(key_path(tree, key), 'This key must be a value, not a tree.') from None
 
 
 class BooleanValidator(ValueValidator):
@@ -34,10 +57,12 @@ class BooleanValidator(ValueValidator):
     desc = 'a boolean (false or true)'
 
     def validate(self, tree, key, value):
+        # The exact type check is the common case, and avoids the
+        # super() call for valid values.
+        if type(value) is bool:
+            return
         super().validate(tree, key, value)
-        if not isinstance(value, bool):
-            p = '.'.join(tree._path + [key])
-            raise ValidationError(p, 'This must be a boolean')
+        raise ValidationError(key_path(tree, key), 'This must be a boolean')
 
 
 class IntegerValidator(ValueValidator):
@@ -45,10 +70,12 @@ class IntegerValidator(ValueValidator):
     desc = 'an integer'
 
     def validate(self, tree, key, value):
+        if type(value) is int:
+            return
         super().validate(tree, key, value)
-        if not isinstance(value, int):
-            p = '.'.join(tree._path + [key])
-            raise ValidationError(p, 'This must be an integer')
+        # Note: booleans are not accepted as integers.
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValidationError(key_path(tree, key), 'This must be an integer')
 
 
 class StringValidator(ValueValidator):
@@ -56,19 +83,18 @@ class StringValidator(ValueValidator):
     desc = 'a string'
 
     def validate(self, tree, key, value):
+        if type(value) is str:
+            return
         super().validate(tree, key, value)
         if not isinstance(value, str):
-            p = '.'.join(tree._path + [key])
-            raise ValidationError(p, 'This must be a string')
+            raise ValidationError(key_path(tree, key), 'This must be a string')
 
 
 class Type(Schema):
 
-    __slots__ = ['__mapping', '__pattern_mapping', '__extra', '__extra_dyn', '__check']
+    __slots__ = ['__mapping', '__pattern_mapping', '__pattern_regex', '__pattern_specs',
+                 '__lookup_cache', '__required', '__required_dyn', '__extra', '__extra_dyn', '__check']
 
-    # TODO: Check if there are pattern. If note, optimize lookup with
-    # dict. If there are only regexes, maybe first check with a
-    # combined regex for faster check?
     def __init__(self, mapping: Dict=None, check: Optional[Callable]=None, extra: Optional[Callable]=None) -> None:
         """
          Args:
@@ -78,10 +104,16 @@ class Type(Schema):
         assert check is None or callable(check)
         self.__mapping = None
         self.__pattern_mapping = None
+        self.__pattern_regex = None
+        self.__pattern_specs = None
+        self.__lookup_cache = {}  # type: Dict[str, Dict]
+        self.__required = frozenset()
+        self.__required_dyn = []
+        self.__extra = {}
         if mapping is not None:
             self.set(mapping)
         self.__check = check
-        self.__extra_dyn = extra or (lambda tree: {})
+        self.__extra_dyn = extra
 
     def set(self, mapping):
         assert self.__mapping is None, 'Cannot set mapping again'
@@ -92,6 +124,9 @@ class Type(Schema):
         self.__mapping = {}
         self.__pattern_mapping = []
         for key, spec in mapping.items():
+            # Interned keys speed up the comparisons with the keys of
+            # the nodes, which are interned too.
+            key = sys.intern(key)
             if callable(spec):
                 self.__extra[key] = spec
             else:
@@ -101,7 +136,7 @@ class Type(Schema):
                 spec = dict(spec)
                 spec.setdefault('type', Schema())
                 spec.setdefault('pattern', False)
-                spec.setdefault('required', lambda tree: False)
+                spec.setdefault('required', False)
                 spec.setdefault('cond', lambda tree: True)
                 spec.setdefault('arg', False)
                 spec.setdefault('extra', {})
@@ -114,24 +149,76 @@ class Type(Schema):
                 assert isinstance(spec['arg'], bool)
                 assert isinstance(spec['extra'], dict)
                 assert callable(spec['pose'])
+                # A constant is kept aside in 'required_const' (None
+                # if dynamic), so that most keys can skip the call.
                 if not callable(spec['required']):
                     v = spec['required']
-                    spec['required'] = lambda tree: v
+                    spec['required_const'] = v
+                    spec['required'] = lambda tree, v=v: v
+                else:
+                    spec['required_const'] = None
                 # FIXME: Replace optional values with actual values.
                 if not spec['pattern']:
                     self.__mapping[key] = spec
                 else:
                     self.__pattern_mapping.append((re.compile(key), dict(spec, regex=key)))
+        # The keys always required, and the keys with a dynamic
+        # 'required' predicate.
+        self.__required = frozenset(k for k, v in self.__mapping.items() if v['required_const'])
+        self.__required_dyn = [(k, v['required']) for k, v in self.__mapping.items()
+                               if v['required_const'] is None]
+        if self.__pattern_mapping:
+            # Combine all the patterns into a single regex. Each
+            # alternative is wrapped in a named group, so that the
+            # name of the outermost matching group tells which
+            # pattern matched first.
+            self.__pattern_specs = {}
+            alternatives = []
+            for i, (pat, spec) in enumerate(self.__pattern_mapping):
+                name = 'p{}'.format(i)
+                self.__pattern_specs[name] = spec
+                alternatives.append('(?P<{}>{})'.format(name, pat.pattern))
+            # Patterns using numbered backreferences, global flags or
+            # clashing group names cannot be combined. Fallback to
+            # matching them one by one.
+            if not any(re.search(r'\\\d', pat.pattern) for pat, _ in self.__pattern_mapping):
+                self.__pattern_regex = self.__compile_combined('|'.join(alternatives))
+
+    @staticmethod
+    def __compile_combined(regex):
+        # RE2, when available, doesn't support every construct of the
+        # re module (lookarounds for instance). Such patterns are
+        # compiled with re instead.
+        if re2 is not None:
+            try:
+                return re2.compile(regex)
+            except re2.error:
+                pass
+        try:
+            return re.compile(regex)
+        except re.error:
+            return None
 
     def _lookup(self, tree, key):
-        for pat, spec in self.__pattern_mapping:
-            if pat.match(key):
-                break
-        else:
+        cache = self.__lookup_cache
+        spec = cache.get(key)
+        if spec is not None:
+            return spec
+        pattern_regex = self.__pattern_regex
+        if pattern_regex is not None:
+            m = pattern_regex.match(key)
+            if m is not None:
+                spec = self.__pattern_specs[m.lastgroup]
+        elif self.__pattern_mapping:
+            for pat, pat_spec in self.__pattern_mapping:
+                if pat.match(key):
+                    spec = pat_spec
+                    break
+        if spec is None:
             try:
                 spec = self.__mapping[key]
             except KeyError:
-                p = '.'.join(tree._path + [key])
+                p = key_path(tree, key)
                 candidates = []  # type: List[str]
                 candidates += sorted(self.__mapping)
                 candidates += ['/{}/'.format(key.pattern) for key, _ in self.__pattern_mapping]
@@ -141,6 +228,11 @@ class Type(Schema):
                     raise ValidationError(p,
                                           'Invalid key. Allowed keys are: {}'
                                           .format(', '.join(candidates))) from None
+        # Invalid keys are not cached, since the error depends on the
+        # tree.
+        if len(cache) >= LOOKUP_CACHE_SIZE:
+            del cache[next(iter(cache))]
+        cache[key] = spec
         return spec
 
     def validate(self, tree, key, value):
@@ -148,8 +240,7 @@ class Type(Schema):
         if isinstance(sub, ValueValidator):
             sub.validate(tree, key, value)
         elif isinstance(sub, Schema):
-            p = '.'.join(tree._path + [key])
-            raise ValidationError(p, 'Expected a tree, not a leaf')
+            raise ValidationError(key_path(tree, key), 'Expected a tree, not a leaf')
 
     def format(self, tree, name):
         try:
@@ -165,24 +256,25 @@ class Type(Schema):
 
     def full_help(self, tree):
         r = []
+        add = r.append
         def doc(name, spec):
             if isinstance(spec['type'], ValueValidator):
                 t = '= ...;'
             else:
                 t = '{ ... }'
-            r.append('{} {}'.format(name if not spec['pattern'] else '/{}/'.format(name), t))
+            add('{} {}'.format(name if not spec['pattern'] else '/{}/'.format(name), t))
             if spec['required'](tree):
-                r.append('  *Required*')
+                add('  *Required*')
             else:
-                r.append('  Optional')
+                add('  Optional')
             if spec.get('description'):
-                r.append('  Description: {}'.format(spec['description']))
-            r.append('')
+                add('  Description: {}'.format(spec['description']))
+            add('')
         if self.__mapping:
             for key, spec in sorted(self.__mapping.items()):
                 doc(key, spec)
         if self.__pattern_mapping:
-            for regex, spec in sorted(self.__pattern_mapping):
+            for regex, spec in sorted(self.__pattern_mapping, key=lambda item: item[1]['regex']):
                 doc(spec['regex'], spec)
         return '\n'.join(r)
 
@@ -205,20 +297,32 @@ class Type(Schema):
             result.append('Optional')
         return '\n'.join(result) or None
 
+    def __missing(self, tree, keys):
+        # Each 'required' predicate is evaluated at most once, and only
+        # for absent keys.
+        missing = set(self.__required.difference(keys))
+        add = missing.add
+        for k, required in self.__required_dyn:
+            if k not in keys and required(tree):
+                add(k)
+        return missing
+
     def check_keys(self, tree):
         keys = tree._keys()
-        here = '.'.join(tree._path)
-        missing = set()
-        for k, v in sorted(self.__mapping.items()):
-            if v['required'](tree) and k not in keys:
-                missing.add(k)
+        # Pattern keys share their spec, so remember 'cond' per spec.
+        allowed = {}  # type: Dict[int, bool]
+        lookup = self._lookup
+        get_allowed = allowed.get
         for k in keys:
-            spec = self._lookup(tree, k)
-            if not spec['cond'](tree):
-                raise ValidationError(here or 'ROOT', 'Key forbidden: {}'.format(k))
-            self.get_validator_for_key(tree, k)
+            spec = lookup(tree, k)
+            ok = get_allowed(id(spec))
+            if ok is None:
+                ok = allowed[id(spec)] = bool(spec['cond'](tree))
+            if not ok:
+                raise ValidationError(key_path(tree), 'Key forbidden: {}'.format(k))
+        missing = self.__missing(tree, keys)
         if missing:
-            raise ValidationError(here or 'ROOT',
+            raise ValidationError(key_path(tree),
                                   'Mandatory key{} missing: {}'
                                   .format('s' if len(missing) > 1 else '', ', '.join(sorted(missing))))
 
@@ -228,16 +332,16 @@ class Type(Schema):
             self.__check(tree)
 
     def choices(self, tree):
-        return set(self.__mapping.keys())
+        return set(self.__mapping or ())
+
+    def fixed_choices(self):
+        # A subclass overriding choices() might depend on the tree.
+        if type(self).choices is not Type.choices or self.__mapping is None:
+            return None
+        return frozenset(self.__mapping)
 
     def missing(self, tree):
-        s = set()
-        keys = tree._keys()
-        for k, v in self.__mapping.items():
-            if v['required'](tree) and k not in keys:
-                p = '.'.join(tree._path + [k])
-                s.add(k)
-        return s
+        return self.__missing(tree, tree._keys())
 
     def get_validator_for_key(self, tree, key):
         spec = self._lookup(tree, key)
@@ -248,17 +352,28 @@ class Type(Schema):
             raise RuntimeError('Schema unset')
         validator = self.get_validator_for_key(tree, key)
         if not isinstance(validator, Schema):
-            p = '.'.join(tree._path + [key])
-            raise ValidationError(p, 'This must be a value, not a tree')
+            raise ValidationError(key_path(tree, key), 'This must be a value, not a tree')
         return validator
 
     def extra(self, tree):
-        r = {k: lambda: v(tree) for k, v in self.__extra.items()}
-        r.update(self.__extra_dyn(tree))
+        r = {k: partial(v, tree) for k, v in self.__extra.items()}
+        if self.__extra_dyn is not None:
+            r.update(self.__extra_dyn(tree))
         return r
 
+    def has_extras(self):
+        # A subclass overriding extra() might give any key.
+        if type(self).extra is not Type.extra:
+            return True
+        return bool(self.__extra) or self.__extra_dyn is not None
+
+    def has_missing(self):
+        if type(self).missing is not Type.missing:
+            return True
+        return bool(self.__required) or bool(self.__required_dyn)
+
     def setup(self, tree):
-        for key, spec in sorted(self.__mapping.items()):
+        for key, spec in self.__mapping.items():
             if spec['required'](tree):
                 if not isinstance(spec['type'], ValueValidator):
                     tree[key] = Empty()
@@ -50,23 +50,30 @@ value.
 
 By using '\t' and '\n' to delimit a record, it make possible to perform
 corruption detection when attempting to load a record.
+
+Optionally, each record can be prefixed by the CRC-32 of its data, as 8
+hexadecimal digits followed by ':'. The record "Hello, World" is then
+stored as:
+
+    <TAB>265b86c6:Hello, World
+
+This must be requested when opening the storage (with checksum=True),
+since nothing in the file tells whether records have a checksum.
 """
 
 # TODO: Prefix record with size in bytes (<TAB>12:Hello, World<NL>)
 # for further data corruption detection?
 
-# TODO: We could even put a checksum
-# (<TAB>12:82bb413746aee42f89dea2b59614f9ef:Hello, World<NL>) but this
-# might be too heavy (or maybe make that conditional).
-
 # TODO: Ensure the file has still the same name? (check inode) This is
 # not atomic, but this could detect a file renaming/file deletion/file
 # overload.
 
-from typing import Optional
+from typing import Callable, List, Optional, Tuple
 
-import io
 import os
+import re
+import mmap
+import zlib
 import fcntl
 from contextlib import contextmanager
 
@@ -84,6 +91,23 @@ DEFAULT_HEADER = 15  # type: int
 # Maximum number of digits to accept for the root pointer.
 MAX_HEADER = 15  # type: int
 
+# Number of bytes to read at once when looking for the end of a line.
+READ_SIZE = 65536  # type: int
+
+# Number of bytes to read first when loading a single record. Most
+# records are much shorter, and the reads grow up to READ_SIZE for
+# longer ones.
+RECORD_READ_SIZE = 4096  # type: int
+
+# Any newline not followed by a record marker, or any record marker not
+# preceded by a newline, in the records area.
+MALFORMED_RECORDS = re.compile(rb'\n[^\t]|[^\n]\t')
+
+# Flush the data of a file to the disk. fdatasync() skips the metadata
+# that doesn't matter for reading the file back (like the modification
+# time), but is not available everywhere.
+datasync = getattr(os, 'fdatasync', os.fsync)
+
 
 class StorageError(RuntimeError):
     pass
@@ -99,10 +123,12 @@ class ConcurrencyError(StorageError):
 
 class Storage:
 
-    __slots__ = ['__file', '__locked', '__lockable']
+    __slots__ = ['__file', '__fd', '__locked', '__lockable', '__header_pos', '__header_size',
+                 '__checksum']
 
-    def __init__(self, f) -> None:
+    def __init__(self, f, checksum: bool=False) -> None:
         self.__file = f
+        self.__checksum = checksum  # type: bool
         if not isinstance(self.__file, BytesIO):
             assert 'b' in self.__file.mode, \
                 'The storage must be open in binary mode'
@@ -115,7 +141,14 @@ class Storage:
         # current one.  Each lock state is used to mark a given range of
         # bytes as either SH (shared), EX (exclusive) or UN (unset).
         self.__locked = False  # type: bool
-        self.__lockable = not isinstance(self.__file, BytesIO)  # type: bool
+        # The raw file descriptor, if any, is fetched once and used
+        # directly for reading, syncing and locking.
+        self.__fd = self.__file.fileno() if not isinstance(self.__file, BytesIO) else None  # type: Optional[int]
+        self.__lockable = self.__fd is not None  # type: bool
+        # The position and size (including '\n') of the line holding
+        # the current offset, located on first use (see __header()).
+        self.__header_pos = None  # type: Optional[int]
+        self.__header_size = None  # type: Optional[int]
 
     @staticmethod
     def _init(f) -> None:
@@ -124,13 +157,9 @@ class Storage:
         """
         f.truncate(0)
         f.seek(0)
-        f.write('{}\n{:0{}d}\n'.format(IDENTIFIER.decode('ascii'), 0, DEFAULT_HEADER).encode('utf-8'))
-        try:
-            fd = f.fileno()
-        except io.UnsupportedOperation:
-            pass
-        else:
-            os.fsync(fd)
+        f.write(b'%s\n%0*d\n' % (IDENTIFIER, DEFAULT_HEADER, 0))
+        if not isinstance(f, BytesIO):
+            datasync(f.fileno())
 
     @staticmethod
     def _create(filename: str) -> None:
@@ -141,7 +170,8 @@ class Storage:
             Storage._init(f)
 
     @staticmethod
-    def open(filename: str, create_if_missing: bool=False, reset_if_exists: bool=False) -> 'Storage':
+    def open(filename: str, create_if_missing: bool=False, reset_if_exists: bool=False,
+             checksum: bool=False) -> 'Storage':
         """
         Open a storage.
 
@@ -153,6 +183,8 @@ class Storage:
               an empty state if already exists. This can be combined
               with create_if_missing to always recreate an empty
               storage, which is useful for testing purpose.
+            checksum -- (bool) if True, records are stored with a
+              checksum, which is verified when loading them.
         """
         assert isinstance(filename, str)
         if reset_if_exists:
@@ -168,10 +200,10 @@ class Storage:
         # neither reset_if_exists nor create_if_missing are set.
         # NOTE: Disabling buffering is important to avoid caches..
         f = open(filename, 'r+b', buffering=0)
-        return Storage(f)
+        return Storage(f, checksum=checksum)
 
     @staticmethod
-    def open_in_memory():
+    def open_in_memory(checksum: bool=False):
         """
         Create an empty storage in memory.
 
@@ -179,7 +211,7 @@ class Storage:
         """
         f = BytesIO()
         Storage._init(f)
-        return Storage(f)
+        return Storage(f, checksum=checksum)
 
     @contextmanager
     def __lock(self, *, write: bool=True):
@@ -202,12 +234,12 @@ class Storage:
         assert not self.__locked, 'Nested lock'
         if self.__lockable:
             flags = fcntl.LOCK_SH if not write else fcntl.LOCK_EX
-            fcntl.lockf(self.__file, flags, 1)
+            fcntl.lockf(self.__fd, flags, 1)
             self.__locked = True
             try:
                 yield
             finally:
-                fcntl.lockf(self.__file, fcntl.LOCK_UN, 1)
+                fcntl.lockf(self.__fd, fcntl.LOCK_UN, 1)
                 self.__locked = False
         else:
             yield
@@ -225,25 +257,113 @@ class Storage:
             formated.
         """
         assert line, 'Empty storage?'
-        if not (2 <= len(line) <= MAX_HEADER+1 and line.endswith(b'\n') and line[:-1].isdigit()):
+        digits = line[:-1]
+        # Note: int() alone would also accept signs, spaces and
+        # underscores, hence the isdigit() check.
+        if not (2 <= len(line) <= MAX_HEADER+1 and line[-1] == 0x0a and digits.isdigit()):
             raise CorruptedFormat('Invalid header ({!r})'.format(line))
-        return int(line)
+        return int(digits)
+
+    def __read(self, size: int) -> bytes:
+        if self.__fd is not None:
+            return os.read(self.__fd, size)
+        else:
+            return self.__file.read(size)
 
     def _getline(self, buffer=b''):
+        """
+        Read a line from the current position.
+
+        Args:
+            buffer -- (bytes) data already read, as returned by a
+              previous call.
+
+        Returns:
+            A tuple with the line (including '\\n') and the data read
+            past its end.
+        """
         p = buffer.find(b'\n')
         if p != -1:
             return buffer[:p+1], buffer[p+1:]
+        # A bytearray grows in place, avoiding to copy the beginning of
+        # a long line again for each chunk.
+        line = bytearray(buffer)
         while True:
-            data = self.__file.read(4096)
+            data = self.__read(READ_SIZE)
             if not data:
-                if not buffer:
+                if not line:
                     return None, b''
                 else:
                     raise RuntimeError('Unterminated line')
             p = data.find(b'\n')
             if p != -1:
-                return buffer + data[:p+1], data[p+1:]
-            buffer += data
+                line += data[:p+1]
+                return bytes(line), data[p+1:]
+            line += data
+
+    def __read_at(self, size: int, offset: int) -> bytes:
+        if self.__fd is not None:
+            return os.pread(self.__fd, size, offset)
+        else:
+            self.__file.seek(offset, 0)
+            return self.__file.read(size)
+
+    def __write_at(self, data: bytes, offset: int) -> None:
+        if self.__fd is not None:
+            view = memoryview(data)
+            while view:
+                n = os.pwrite(self.__fd, view, offset)
+                view = view[n:]
+                offset += n
+        else:
+            self.__file.seek(offset, 0)
+            self.__file.write(data)
+
+    def __readline_at(self, offset: int) -> bytes:
+        """
+        Read the line starting at the given offset.
+
+        The result doesn't end with '\\n' if the end of the file is
+        reached first.
+        """
+        size = RECORD_READ_SIZE
+        data = self.__read_at(size, offset)
+        p = data.find(b'\n')
+        if p != -1:
+            return data[:p+1]
+        line = bytearray(data)
+        while data:
+            size = min(size * 2, READ_SIZE)
+            data = self.__read_at(size, offset + len(line))
+            p = data.find(b'\n')
+            if p != -1:
+                line += data[:p+1]
+                break
+            line += data
+        return bytes(line)
+
+    def __header(self) -> Tuple[int, int]:
+        """
+        Get the position and size of the line holding the current
+        offset. Must be called with the lock held.
+
+        Neither can change once the storage is created, so the
+        identifier is only checked the first time.
+        """
+        if self.__header_pos is None:
+            self.__file.seek(0, 0)
+            line, buffer = self._getline()
+            if line is None:
+                raise CorruptedFormat('Empty file')
+            if line[:-1] != IDENTIFIER:
+                raise CorruptedFormat('Identifier not found at offset 0 (line 1)')
+            pos = len(line)
+            line, buffer = self._getline(buffer)
+            if line is None:
+                raise CorruptedFormat('Unterminated line at offset {} (line 2)'.format(pos))
+            self.__header_size = len(line)
+            self.__header_pos = pos
+        return self.__header_pos, self.__header_size
 
     def get_current(self) -> int:
         """
@@ -251,11 +371,9 @@ class Storage:
         """
         # Maybe we don't need a lock, since the file is open with
         # unbuffered access.
-        self.__file.seek(0, 0)
         with self.__lock(write=False):
-            line, buffer = self._getline()
-            assert line[:-1] == IDENTIFIER, 'Unrecognized file format'
-            line, buffer = self._getline(buffer)
+            pos, size = self.__header()
+            line = self.__read_at(size, pos)
         return self._parse_current_offset(line)
 
     def set_current(self, offset: int, lease: Optional[int]=None) -> None:
@@ -269,25 +387,17 @@ class Storage:
               Compare-And-Swap (CAS) operation. If the value is
               different, an exception is thrown.
         """
-        self.__file.seek(0, 0)
         with self.__lock():
-            line, buffer = self._getline()
-            assert line[:-1] == IDENTIFIER, 'Unrecognized file format'
-            pos = len(line)
-            line, buffer = self._getline(buffer)
+            pos, size = self.__header()
+            line = self.__read_at(size, pos)
             current_offset = self._parse_current_offset(line)
             if lease is not None and current_offset != lease:
                 raise ConcurrencyError('target={}, current={}, expected={}'.format(offset, current_offset, lease))
-            new_line = '{:0{}d}\n'.format(offset, len(line)-1).encode('utf-8')
+            new_line = b'%0*d\n' % (len(line)-1, offset)
             assert len(new_line) == len(line), '{!r} vs {!r}'.format(new_line, line)
-            self.__file.seek(pos, 0)
-            self.__file.write(new_line)
-            try:
-                fd = self.__file.fileno()
-            except io.UnsupportedOperation:
-                pass
-            else:
-                os.fsync(fd)
+            self.__write_at(new_line, pos)
+            if self.__fd is not None:
+                datasync(self.__fd)
 
     def load(self, offset: int) -> bytes:
         """
@@ -299,15 +409,58 @@ class Storage:
         Returns:
             The record as a byte string.
         """
-        self.__file.seek(offset)
-        line, buffer = self._getline()
+        return self.__parse_line(self.__readline_at(offset), offset)
+
+    def load_many(self, offsets: List[int]) -> List[bytes]:
+        """
+        Load the records at the given offsets.
+
+        The storage is mapped once for all the records, instead of
+        reading each of them with a system call.
+
+        Args:
+            offsets -- (list of int) the offsets of the records to read.
+
+        Returns:
+            The records as byte strings, in the same order.
+        """
+        records = []
+        add = records.append
+        with self.__contents() as data:
+            for offset in offsets:
+                end = data.find(b'\n', offset)
+                add(self.__parse_line(data[offset:] if end == -1 else data[offset:end+1], offset))
+        return records
+
+    def __parse_line(self, line: bytes, offset: int) -> bytes:
         if not line.startswith(b'\t'):
             raise CorruptedFormat('Missing marker at offset {}'.format(offset))
         if not line.endswith(b'\n'):
             raise CorruptedFormat('Unterminated line at offset {}'.format(offset))
         if line.find(b'\t', 1) != -1:
             raise CorruptedFormat('{} is not pointing at the beginning of a record'.format(offset))
-        return line[1:-1]
+        return self._unwrap(line[1:-1], offset)
+
+    def _wrap(self, record: bytes) -> bytes:
+        """
+        Add the checksum, if enabled, in front of a record.
+        """
+        if not self.__checksum:
+            return record
+        return b'%08x:%s' % (zlib.crc32(record), record)
+
+    def _unwrap(self, data: bytes, offset: int) -> bytes:
+        """
+        Remove and verify the checksum, if enabled, of a stored record.
+        """
+        if not self.__checksum:
+            return data
+        if len(data) < 9 or data[8] != 0x3a:
+            raise CorruptedFormat('Missing checksum at offset {}'.format(offset))
+        record = data[9:]
+        if data[:8] != b'%08x' % zlib.crc32(record):
+            raise CorruptedFormat('Checksum mismatch at offset {}'.format(offset))
+        return record
 
     def store(self, record: bytes) -> int:
         r"""
@@ -321,17 +474,74 @@ class Storage:
         Returns:
             The record offset.
         """
+        # Everything not depending on the file is done before taking
+        # the lock, to keep the critical section short.
+        assert b'\t' not in record, 'TAB (\\t) characters are forbidden in record.'
+        assert b'\n' not in record, 'NL (\\n) characters are forbidden in record.'
+        payload = b''.join((b'\t', self._wrap(record), b'\n'))
         with self.__lock():
-            self.__file.seek(0, 2)
-            pos = self.__file.tell()
+            pos = self.__file.seek(0, 2)
             # "0\n" is the minimum possible header (even if almost useless)
             assert pos >= 2, 'Empty storage?'
-            assert b'\t' not in record, 'TAB (\\t) characters are forbidden in record.'
-            assert b'\n' not in record, 'NL (\\n) characters are forbidden in record.'
-            self.__file.write(b'\t' + record + b'\n')
-            self.__file.flush()
+            self.__write_at(payload, pos)
         return pos
 
+    def store_batch(self, build: Callable[[Callable[[bytes], int]], None]) -> None:
+        r"""
+        Store several records with a single write.
+
+        `build` is called with a function storing a record and returning
+        its offset, like store(). It is first called without holding the
+        lock, the records being appended at the current end of the
+        storage. If another process appended records meanwhile, `build`
+        is called again with the lock held, and must give the same
+        records (at the new offsets).
+        """
+        def prepare(start):
+            payloads = []
+            pos = start
+            def store(record: bytes) -> int:
+                nonlocal pos
+                assert b'\t' not in record, 'TAB (\\t) characters are forbidden in record.'
+                assert b'\n' not in record, 'NL (\\n) characters are forbidden in record.'
+                payload = b''.join((b'\t', self._wrap(record), b'\n'))
+                payloads.append(payload)
+                offset = pos
+                pos += len(payload)
+                return offset
+            build(store)
+            return payloads
+        start = self.__file.seek(0, 2)
+        payloads = prepare(start)
+        with self.__lock():
+            pos = self.__file.seek(0, 2)
+            assert pos >= 2, 'Empty storage?'
+            if pos != start:
+                start = pos
+                payloads = prepare(start)
+            if payloads:
+                self.__write_at(b''.join(payloads), start)
+
+    @contextmanager
+    def __contents(self):
+        """
+        A context manager giving read-only access to the whole storage.
+
+        The file is memory mapped, so that scanning it doesn't require
+        a system call per line.
+        """
+        if self.__fd is None:
+            yield self.__file.getvalue()
+        elif not os.fstat(self.__fd).st_size:
+            # An empty file cannot be mapped.
+            yield b''
+        else:
+            m = mmap.mmap(self.__fd, 0, access=mmap.ACCESS_READ)
+            try:
+                yield m
+            finally:
+                m.close()
+
     def scan(self):
         """
         Check the integrity of the storage.
@@ -339,35 +549,45 @@ class Storage:
         Throw:
             A CorruptedFormat exception if an error is found.
         """
-        self.__file.seek(0)
-        with self.__lock():
+        with self.__lock(), self.__contents() as data:
+            size = len(data)
             i = 1
             offset = 0
-            line = self.__file.readline()
-            if not line:
+            if not size:
                 raise CorruptedFormat('Empty file')
-            if not line.endswith(b'\n'):
+            p = data.find(b'\n')
+            if p == -1:
                 raise CorruptedFormat('Unterminated line at offset {} (line {})'.format(offset, i))
-            if line[:-1] != IDENTIFIER:
+            if data[:p] != IDENTIFIER:
                 raise CorruptedFormat('Identifier not found at offset {} (line {})'.format(offset, i))
-            offset = self.__file.tell()
-            line = self.__file.readline()
-            if not line.endswith(b'\n'):
+            offset = p + 1
+            p = data.find(b'\n', offset)
+            if p == -1:
                 raise CorruptedFormat('Unterminated line at offset {} (line {})'.format(offset, i))
-            self._parse_current_offset(line)  # Used for checking syntax
+            self._parse_current_offset(data[offset:p+1])  # Used for checking syntax
             i += 1
-            while 1:
-                offset = self.__file.tell()
-                line = self.__file.readline()
-                if not line:
-                    break
-                if not line.endswith(b'\n'):
+            offset = p + 1
+            # Checking all the records at once is done in C. The loop
+            # below is only needed to locate an error.
+            if (MALFORMED_RECORDS.search(data, offset - 1) is None
+                and (offset == size or data[size-1] == 0x0a)):
+                if self.__checksum:
+                    while offset < size:
+                        p = data.find(b'\n', offset)
+                        self._unwrap(data[offset+1:p], offset)
+                        offset = p + 1
+                return
+            while offset < size:
+                p = data.find(b'\n', offset)
+                if p == -1:
                     raise CorruptedFormat('Unterminated line at offset {} (line {})'.format(offset, i))
-                if not line.startswith(b'\t'):
+                if data[offset] != 0x09:
                     raise CorruptedFormat('Missing marker at offset {} (line {})'.format(offset, i))
-                if line.find(b'\t', 1) != -1:
+                if data.find(b'\t', offset + 1, p) != -1:
                     raise CorruptedFormat('Marker find within a record at offset {} (line {})'.format(offset, i))
+                self._unwrap(data[offset+1:p], offset)
                 i += 1
+                offset = p + 1
 
     def records(self):
         """
@@ -376,36 +596,36 @@ class Storage:
         Yields:
             First the "current offset" line, then each records.
         """
-        self.__file.seek(0)
-        with self.__lock():
+        with self.__lock(), self.__contents() as data:
+            size = len(data)
             offset = 0
-            line = self.__file.readline()
-            if not line.endswith(b'\n'):
+            p = data.find(b'\n')
+            if p == -1:
                 raise CorruptedFormat('Unterminated line at offset {}'.format(offset))
-            if line[:-1] != IDENTIFIER:
+            if data[:p] != IDENTIFIER:
                 raise CorruptedFormat('Identifier not found on the first line {!r}')
-            yield offset, line[:-1]
-            offset = self.__file.tell()
-            line = self.__file.readline()
-            if not line.endswith(b'\n'):
+            yield offset, data[:p]
+            offset = p + 1
+            p = data.find(b'\n', offset)
+            if p == -1:
                 raise CorruptedFormat('Unterminated line at offset {}'.format(offset))
-            yield offset, line[:-1]
-            while 1:
-                offset = self.__file.tell()
-                line = self.__file.readline()
-                if not line:
-                    break
-                if not line.endswith(b'\n'):
+            yield offset, data[offset:p]
+            offset = p + 1
+            while offset < size:
+                p = data.find(b'\n', offset)
+                if p == -1:
                     raise CorruptedFormat('Unterminated line at offset {}'.format(offset))
-                if not line.startswith(b'\t'):
+                if data[offset] != 0x09:
                     raise CorruptedFormat('Missing marker at offset {}'.format(offset))
-                if line.find(b'\t', 1) != -1:
+                if data.find(b'\t', offset + 1, p) != -1:
                     raise CorruptedFormat('Marker find within a record at offset {}'.format(offset))
-                yield offset, line[1:-1]
+                yield offset, self._unwrap(data[offset+1:p], offset)
+                offset = p + 1
 
     def _dump(self, printer):
+        output = printer.plain
         for offset, record in self.records():
-            printer('{:4d} | {}'.format(offset, record.decode('utf-8')))
+            output('{:4d} | {}'.format(offset, record.decode('utf-8')))
 
     def dump(self):
         self._dump(Printer())
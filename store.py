@@ -1,16 +1,105 @@
 #!/usr/bin/env python3
 
-from typing import Any, Optional, Union, Callable
+from typing import Any, Dict, List, Optional, Union, Callable
 
+import re
 import json
+import math
+import hashlib
+from sys import intern
+from bisect import bisect_left, insort
 from enum import Enum
-from collections import namedtuple
-from weakref import ref as weakref
+from collections import namedtuple, OrderedDict
+from weakref import WeakValueDictionary
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
 
 from storage import Storage
 from utils import Printer
 
 
+# orjson decodes integers that don't fit in 64 bits as floats. Data
+# with such long runs of digits is decoded with json instead (19 digits
+# already go below -2**63).
+LONG_DIGITS = re.compile(rb'\d{19}')
+
+# Maximum number of records remembered by a Store to reuse them.
+RECORD_CACHE_SIZE = 65536  # type: int
+
+# Maximum number of decoded records kept by a volatile Store.
+ITEM_CACHE_SIZE = 4096  # type: int
+
+
+def has_non_finite(value: Any) -> bool:
+    """
+    Tell if a value contains NaN or an infinity.
+    """
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, float):
+            if not math.isfinite(v):
+                return True
+        elif isinstance(v, dict):
+            stack += v.keys()
+            stack += v.values()
+        elif isinstance(v, (list, tuple)):
+            stack += v
+    return False
+
+
+def encode(value: Any) -> bytes:
+    """
+    Encode a value as compact JSON, with sorted keys.
+    """
+    if orjson is not None:
+        try:
+            r = orjson.dumps(value, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # For instance, integers larger than 64 bits.
+            pass
+        else:
+            # orjson writes NaN and infinities as null, which would load
+            # back as None. json keeps them.
+            if b'null' not in r or not has_non_finite(value):
+                return r
+    return json.dumps(value, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+
+def encode_node(entries: List) -> bytes:
+    """
+    Encode a node from its (key, offset) entries, sorted by key.
+
+    The result is the same as encode() of the corresponding dict, so
+    that identical records can be reused, but the JSON is built
+    directly.
+    """
+    if orjson is not None:
+        dumps = orjson.dumps
+        try:
+            return b'{%s}' % b','.join([b'%s:%d' % (dumps(key), offset) for key, offset in entries])
+        except orjson.JSONEncodeError:
+            return encode(dict(entries))
+    dumps = json.dumps
+    return b'{%s}' % b','.join([b'%s:%d' % (dumps(key).encode('utf-8'), offset) for key, offset in entries])
+
+
+def decode(data: bytes) -> Any:
+    """
+    Decode JSON data.
+    """
+    if orjson is not None and LONG_DIGITS.search(data) is None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # For instance, NaN.
+            pass
+    return json.loads(data.decode('utf-8'))
+
+
 class StoreError(RuntimeError):
     pass
 
@@ -37,33 +126,51 @@ class Kind(Enum):
         return '<{}>'.format(self.name)
 
 
+# Kind is not used internally, to avoid an Enum lookup per record:
+# the prefix of the records, and their first byte.
+NODE_PREFIX = Kind.node.value  # type: bytes
+LEAF_PREFIX = Kind.leaf.value  # type: bytes
+NODE_TAG = NODE_PREFIX[0]  # type: int
+LEAF_TAG = LEAF_PREFIX[0]  # type: int
+
+
 class Store:
 
-    __slots__ = ['__storage', '__current_root', '__root', '__volatile']
+    __slots__ = ['__storage', '__current_root', '__root', '__volatile', '__records', '__decoded']
 
     # `volatile` is experimental.. and doesn't work perfectly.. yet.
-    def __init__(self, storage: Storage, volatile: bool=False, alternate_root: Optional[int]=None) -> None:
+    # `dedup` allows identical records to share the same offset.
+    def __init__(self, storage: Storage, volatile: bool=False, alternate_root: Optional[int]=None,
+                 dedup: bool=True) -> None:
         assert isinstance(storage, Storage)
         self.__storage = storage
         self.__current_root = self.__storage.get_current() if alternate_root is None else alternate_root  # type: int
         self.__root = self.__current_root  # type: Union[int, Item]
         self.__volatile = volatile
+        # Offsets of known records, by digest of their content.
+        self.__records = {} if dedup else None  # type: Optional[Dict[bytes, int]]
+        # Recently decoded records, by offset, as (tag, data, payload).
+        # Volatile nodes release their unmodified entries, which are
+        # then loaded again. The payload is only kept (instead of the
+        # data) for mutable values.
+        self.__decoded = OrderedDict() if volatile else None  # type: Optional[OrderedDict]
 
     @classmethod
-    def open(cls, filename: str, create_if_missing: bool=False, volatile: bool=False) -> 'Store':
+    def open(cls, filename: str, create_if_missing: bool=False, volatile: bool=False,
+             dedup: bool=True) -> 'Store':
         """
         """
         assert isinstance(filename, str)
         storage = Storage.open(filename, create_if_missing=create_if_missing)
-        return cls(storage, volatile=volatile)
+        return cls(storage, volatile=volatile, dedup=dedup)
 
     @classmethod
-    def open_in_memory(cls, volatile: bool=False) -> 'Store':
+    def open_in_memory(cls, volatile: bool=False, dedup: bool=True) -> 'Store':
         """
         """
         # For testing
         storage = Storage.open_in_memory()
-        return cls(storage, volatile=volatile)
+        return cls(storage, volatile=volatile, dedup=dedup)
 
     def diff(self):
         # FIXME: The diff could be vastly optimized by knowing if a
@@ -81,39 +188,101 @@ class Store:
             return '.'.join(p)
         def val(l):
             return json.dumps(l.value)
-        def rec(p, a, b):
-            yield ('enter', p, a, b)
-            if isinstance(a, Node):
-                if isinstance(b, Node):
-                    ka = a.keys()
-                    kb = b.keys()
-                    for removed_key in ka - kb:
-                        yield ('removed', p + [removed_key], a.get(removed_key))
-                    for new_key in kb - ka:
-                        yield ('added', p + [new_key], b.get(new_key))
-                    for common_key in ka & kb:
-                        yield from rec(p + [common_key], a.get(common_key), b.get(common_key))
-                elif isinstance(b, Leaf):
-                    yield ('changed', p, a, b)
+        load_raw = self._load_raw
+        def entries(p, a, b):
+            # Compare the entries of two nodes, with a single merge pass
+            # over both sorted key lists, which also yields the
+            # differences in key order. The pairs of entries to compare
+            # are yielded as (None, path, a, b).
+            ka = a.sorted_keys()
+            kb = b.sorted_keys()
+            na = len(ka)
+            nb = len(kb)
+            i = j = 0
+            while i < na or j < nb:
+                if j == nb or (i < na and ka[i] < kb[j]):
+                    key = ka[i]
+                    i += 1
+                    yield ('removed', p + (key,), a.get(key))
+                elif i == na or kb[j] < ka[i]:
+                    key = kb[j]
+                    j += 1
+                    yield ('added', p + (key,), b.get(key))
                 else:
-                    raise TypeError
-            elif isinstance(a, Leaf):
-                if isinstance(b, Node):
-                    yield ('changed', p, a, b)
-                elif isinstance(b, Leaf):
-                    if a.value != b.value:
+                    key = ka[i]
+                    i += 1
+                    j += 1
+                    # Both trees share the same storage, so the same
+                    # offset means the same (unchanged) subtree, which
+                    # is skipped without loading it. Identical records
+                    # stored twice are skipped too. Otherwise, the records
+                    # already read are decoded without reading them again.
+                    record_a = record_b = None
+                    offset_a = a._entry_offset(key)
+                    if offset_a is not None:
+                        offset_b = b._entry_offset(key)
+                        if offset_a == offset_b:
+                            continue
+                        if offset_b is not None:
+                            record_a = load_raw(offset_a)
+                            record_b = load_raw(offset_b)
+                            if record_a == record_b:
+                                continue
+                    yield (None, p + (key,), a.get(key, record_a), b.get(key, record_b))
+        # Not in the assertions, which must not have side effects
+        # (loading the roots).
+        a = current.root
+        b = self.root
+        assert isinstance(a, Node)
+        assert isinstance(b, Node)
+        # The trees are walked with an explicit stack of the nodes being
+        # compared, rather than recursive generators: each event would
+        # otherwise go through one `yield from` per level.
+        stack = []
+        todo = (None, (), a, b)
+        while True:
+            if todo is not None:
+                _, p, a, b = todo
+                todo = None
+                yield ('enter', p, a, b)
+                kind_a = a.KIND
+                kind_b = b.KIND
+                if kind_a is Kind.node:
+                    if kind_b is Kind.node:
+                        stack.append((entries(p, a, b), p, a, b))
+                    elif kind_b is Kind.leaf:
                         yield ('changed', p, a, b)
+                        yield ('leave', p, a, b)
                     else:
-                        # Identical
-                        pass
+                        raise TypeError
+                elif kind_a is Kind.leaf:
+                    if kind_b is Kind.node:
+                        yield ('changed', p, a, b)
+                    elif kind_b is Kind.leaf:
+                        if a.offset is not None and a.offset == b.offset:
+                            # Same record, no need to compare the values.
+                            pass
+                        elif a.value != b.value:
+                            yield ('changed', p, a, b)
+                        else:
+                            # Identical
+                            pass
+                    else:
+                        raise TypeError
+                    yield ('leave', p, a, b)
                 else:
                     raise TypeError
+            if not stack:
+                break
+            it, p, a, b = stack[-1]
+            for event in it:
+                if event[0] is None:
+                    todo = event
+                    break
+                yield event
             else:
-                raise TypeError
-            yield ('leave', p, a, b)
-        assert isinstance(current.root, Node)
-        assert isinstance(self.root, Node)
-        yield from rec([], current.__root, self.__root)
+                stack.pop()
+                yield ('leave', p, a, b)
 
     def _reset(self) -> None:
         self.__root = self.__current_root
@@ -129,33 +298,159 @@ class Store:
         self.__root = None
         return value
 
-    def _load(self, offset: int) -> 'Item':
+    def _load(self, offset: int, record: Optional[bytes]=None) -> 'Item':
+        """
+        Load the item at the given offset.
+
+        The record can be given if it was already read.
+        """
         assert isinstance(offset, int)
-        record = self.__storage.load(offset)
+        decoded = self.__decoded
+        if decoded is not None and offset in decoded:
+            decoded.move_to_end(offset)
+            tag, data, payload = decoded[offset]
+            if payload is not None:
+                data = decode(payload)
+        else:
+            if record is None:
+                record = self.__storage.load(offset)
+            tag, data = self.__decode(offset, record)
+            if decoded is not None:
+                if len(decoded) >= ITEM_CACHE_SIZE:
+                    decoded.popitem(last=False)
+                # The values of leaves can be modified in place, so the
+                # mutable ones are decoded again for each item.
+                if tag == LEAF_TAG and isinstance(data, (list, dict)):
+                    decoded[offset] = (tag, None, record[1:])
+                else:
+                    decoded[offset] = (tag, data, None)
+        return self.__item(tag, data, offset)
+
+    def _load_many(self, offsets: List[int]) -> List['Item']:
+        """
+        Load the items at the given offsets, reading the storage once.
+        """
+        records = self.__storage.load_many(offsets)
+        return [self.__item(*self.__decode(offset, record), offset)
+                for offset, record in zip(offsets, records)]
+
+    def __item(self, tag: int, data: Any, offset: int) -> 'Item':
+        if tag == NODE_TAG:
+            return (Node if not self.__volatile else VolatileNode)(data, self, offset)
+        else:
+            return Leaf(data, self, offset)
+
+    def _load_raw(self, offset: int) -> bytes:
+        """
+        Load the record at the given offset, without decoding it.
+        """
+        return self.__storage.load(offset)
+
+    def __decode(self, offset: int, record: bytes):
+        if self.__records is not None:
+            self.__remember(hashlib.blake2b(record, digest_size=16).digest(), offset)
         if len(record) < 2:
             raise StoreError('Record at offset {} is too short'.format(offset))
+        tag = record[0]
+        if tag != NODE_TAG and tag != LEAF_TAG:
+            raise StoreError('Unexpected kind of record ({!r})'.format(record[:1]))
         try:
-            kind = Kind(record[:1])
-        except:
-            raise
-        try:
-            data = json.loads(record[1:].decode('utf-8'))
+            data = decode(record[1:])
         except:
             raise StoreError('Unable to decode JSON')
-        if kind is Kind.node:
-            if (not isinstance(data, dict)
-                or not all(isinstance(key, str) for key in data.keys())
-                or not all(isinstance(value, int) for value in data.values())):
+        # JSON object keys are always strings, so only the values of
+        # a node need to be checked (without a Python loop).
+        if tag == NODE_TAG:
+            if type(data) is not dict or not set(map(type, data.values())) <= {int}:
                 raise StoreError('Node malformed')
-            return Node(data, self, offset)
-        elif kind is Kind.leaf:
-            return Leaf(data, self, offset)
-        else:
-            raise RuntimeError('Unexpected kind ({!r})'.format(kind))
+        return tag, data
+
+    def __remember(self, digest: bytes, offset: int) -> None:
+        records = self.__records
+        if len(records) >= RECORD_CACHE_SIZE:
+            del records[next(iter(records))]
+        records[digest] = offset
+
+    def _record(self, prefix: bytes, value: Any) -> int:
+        """
+        Store a value, prefixed by the kind of record (NODE_PREFIX or
+        LEAF_PREFIX).
+        """
+        return self._record_raw(prefix, encode(value))
 
-    def _record(self, kind: Kind, value: Any) -> int:
-        data = json.dumps(value, separators=(',', ':'), sort_keys=True).encode('utf-8')
-        return self.__storage.store(kind.value + data)
+    def _record_raw(self, prefix: bytes, payload: bytes) -> int:
+        """
+        Store an already encoded value.
+        """
+        return self.__store_record(prefix + payload, self.__storage.store)
+
+    def __store_record(self, record: bytes, store: Callable[[bytes], int],
+                       pending: Optional[Dict[bytes, int]]=None) -> int:
+        """
+        Store a record, or reuse an identical one.
+
+        The records of a batch not written yet are remembered in
+        `pending` if given.
+        """
+        if self.__records is None:
+            return store(record)
+        # Records are never modified once stored, so an identical
+        # record (a leaf with the same value, or a node with the same
+        # children) can be reused instead of storing a copy.
+        digest = hashlib.blake2b(record, digest_size=16).digest()
+        offset = self.__records.get(digest)
+        if offset is None and pending is not None:
+            offset = pending.get(digest)
+        if offset is None:
+            offset = store(record)
+            if pending is None:
+                self.__remember(digest, offset)
+            else:
+                pending[digest] = offset
+        return offset
+
+    def _persist_tree(self, root: 'Item') -> None:
+        """
+        Persist a modified item, and its modified descendants.
+
+        The tree is walked without recursion, children first. All the
+        records are encoded before taking the lock of the storage, and
+        written at once.
+        """
+        assert root.attached, \
+            'Asked to persist an item that is not attached'
+        items = []  # type: List[Item]
+        stack = [(root, False)]
+        while stack:
+            item, visited = stack.pop()
+            if visited:
+                items.append(item)
+            else:
+                stack.append((item, True))
+                stack.extend((child, False) for child in item._modified_children())
+        store_record = self.__store_record
+        pending = {}  # type: Dict[bytes, int]
+        def build(store):
+            # Called again if the storage grew meanwhile, and the offsets
+            # given previously are then wrong.
+            pending.clear()
+            discard(items)
+            for item in items:
+                item._set_offset(store_record(item._encode(), store, pending))
+        def discard(items):
+            for item in items:
+                if item.offset is not None:
+                    item._discard_offset()
+        try:
+            self.__storage.store_batch(build)
+        except:
+            # The records were not written.
+            discard(items)
+            raise
+        for digest, offset in pending.items():
+            self.__remember(digest, offset)
+        for item in items:
+            item._persisted()
 
     def _get_root(self) -> 'Item':
         if self.__root is None:
@@ -179,6 +474,11 @@ class Store:
     def _child_changed(self, key) -> None:
         assert key == '__ROOT__'
 
+    def _entry_offset(self, key) -> Optional[int]:
+        assert key == '__ROOT__'
+        root = self.__root
+        return root.offset if isinstance(root, Item) else root
+
     def commit(self) -> int:
         if self.__root is None:
             raise DetachedRoot('Cannot commit with a detached root')
@@ -186,7 +486,7 @@ class Store:
             offset = self.__root
         elif isinstance(self.__root, Item):
             if self.__root.offset is None:
-                self.__root._persist(self)
+                self._persist_tree(self.__root)
             offset = self.__root.offset
         else:
             raise TypeError(self.__root.__class__)
@@ -214,7 +514,9 @@ class Link(namedtuple('Link', ['parent', 'key'])):
 
     @property
     def offset(self):
-        return self.parent._offset_of(self.key)
+        # Not cached: this is a dict lookup in the parent, and the
+        # offset changes whenever the linked item is persisted.
+        return self.parent._entry_offset(self.key)
 
 
 Ref = namedtuple('Ref', ['store', 'offset'])
@@ -224,6 +526,9 @@ class Item:
 
     __slots__ = ['__link', '__store', '__offset', '__weakref__']
 
+    # The kind of item, cheaper to check than isinstance().
+    KIND = None  # type: Optional[Kind]
+
     def __init__(self, store, offset):
         if store is not None or offset is not None:
             assert isinstance(store, Store)
@@ -233,8 +538,26 @@ class Item:
         self.__offset = offset  # type: Optional[int]
 
     def _persist(self, store) -> int:
+        if self.offset is None:
+            store._persist_tree(self)
+
+    def _modified_children(self) -> List['Item']:
+        """
+        Get the children which must be persisted before this item.
+        """
+        return []
+
+    def _encode(self) -> bytes:
+        """
+        Get the record of this item, once its children are persisted.
+        """
         raise NotImplementedError(self.__class__)
 
+    def _persisted(self) -> None:
+        """
+        Called once the item is persisted.
+        """
+
     @property
     def offset(self):
         return self.__offset
@@ -246,6 +569,12 @@ class Item:
         assert self.modified
         self.__offset = offset
 
+    def _discard_offset(self):
+        """
+        Forget an offset given for a record which was not written.
+        """
+        self.__offset = None
+
     def _child_changed(self, key):
         self._changed()
 
@@ -277,17 +606,20 @@ class Item:
 
 class Leaf(Item):
 
-    __slots__ = ['__value']
+    __slots__ = ['__value', '__encoded']
+
+    KIND = Kind.leaf
 
     def __init__(self, value: Any, store: Store=None, offset: int=None) -> None:
         super().__init__(store, offset)
         self.__value = value
+        # The encoded value, computed once until the value changes.
+        self.__encoded = None  # type: Optional[bytes]
 
-    def _persist(self, store: Store) -> int:
-        assert self.attached, \
-            'Asked to persist an item that is not attached'
-        assert self.offset is None
-        self._set_offset(store._record(Kind.leaf, self.__value))
+    def _encode(self) -> bytes:
+        if self.__encoded is None:
+            self.__encoded = encode(self.__value)
+        return LEAF_PREFIX + self.__encoded
 
     def get(self):
         return self.__value
@@ -295,12 +627,15 @@ class Leaf(Item):
     def set(self, value):
         assert not isinstance(value, Item)  # FIXME: json type
         self.__value = value
+        self.__encoded = None
         self._changed()
 
     value = property(get, set)
 
     def clone(self):
-        return Leaf(self.__value)
+        leaf = Leaf(self.__value)
+        leaf.__encoded = self.__encoded
+        return leaf
 
     def __repr__(self):
         return 'Leaf({!r})'.format(self.__value)
@@ -308,69 +643,137 @@ class Leaf(Item):
 
 class Node(Item):
 
-    __slots__ = ['__entries', '__store']
+    __slots__ = ['__offsets', '__loaded', '__store', '__sorted_keys']
+
+    KIND = Kind.node
 
     def __init__(self, entries=None, store: Store=None, offset: int=None) -> None:
         super().__init__(store, offset)
         if entries is None and store is None:
             entries = {}
         else:
+            # The entries were validated by Store._load.
             assert isinstance(entries, dict)
-            assert all(isinstance(k, str) for k in entries.keys())
-            assert all(isinstance(v, int) for v in entries.values())
             assert isinstance(store, Store)
-            entries = {k: (v, None) for k, v in entries.items()}
-        self.__entries = entries
+            # Keys are interned, since they are compared with the
+            # (interned) keys of the schemas.
+            entries = {intern(k): v for k, v in entries.items()}
+        # Each entry is either only known by the offset of its record,
+        # or loaded in memory (possibly modified).
+        self.__offsets = entries  # type: Dict[str, int]
+        self.__loaded = {}  # type: Dict[str, Item]
         self.__store = store
-
-    def _persist(self, store: Store) -> int:
-        assert self.attached, \
-            'Asked to persist an item that is not attached'
-        node = {}
-        for key, item in sorted(self.__entries.items()):
-            if isinstance(item, tuple):
-                offset = item[0]
+        self.__sorted_keys = None  # type: Optional[List[str]]
+
+    def _modified_children(self) -> List[Item]:
+        return [item for item in map(self._resident, self.keys())
+                if item is not None and item.offset is None]
+
+    def _encode(self) -> bytes:
+        entries = []
+        add = entries.append
+        offsets = self.__offsets
+        resident = self._resident
+        for key in self.sorted_keys():
+            item = resident(key)
+            if item is None:
+                add((key, offsets[key]))
             else:
-                if item.offset is None:
-                    item._persist(store)
-                offset = item.offset
-                if store.volatile:
-                    self.__entries[key] = (offset, weakref(item))
-            node[key] = offset
-        self._set_offset(store._record(Kind.node, node))
+                assert item.offset is not None, 'Child not persisted'
+                add((key, item.offset))
+        return NODE_PREFIX + encode_node(entries)
 
     def keys(self):
-        return set(self.__entries)
-
-    def get(self, key: str) -> Item:
-        entry = self.__entries[key]
-        if isinstance(entry, tuple):
-            offset, entry = entry
-            if entry is not None:
-                entry = entry()
-            if entry is None:
-                entry = self.__store._load(offset)
-                entry._attach(Link(self, key))
-                if self.__store.volatile:
-                    self.__entries[key] = (offset, weakref(entry))
-                else:
-                    self.__entries[key] = entry
-        return entry
+        return self.__offsets.keys() | self.__loaded.keys()
+
+    def sorted_keys(self):
+        """
+        Get the keys in sorted order.
+
+        The result is kept up to date as keys are added or removed,
+        and must not be modified.
+        """
+        if self.__sorted_keys is None:
+            self.__sorted_keys = sorted(self.keys())
+        return self.__sorted_keys
+
+    def _entry_offset(self, key: str) -> Optional[int]:
+        """
+        Get the offset of an entry, without loading it.
+
+        Returns None if the entry was modified since it was persisted.
+        """
+        item = self._resident(key)
+        if item is not None:
+            return item.offset
+        else:
+            return self.__offsets[key]
+
+    # The following methods define how entries are held, and are
+    # overridden by VolatileNode.
+
+    def _resident(self, key: str) -> Optional[Item]:
+        """
+        Get an entry if it is in memory.
+        """
+        return self.__loaded.get(key)
+
+    def _keep(self, key: str, item: Item) -> None:
+        """
+        Hold an entry in memory.
+        """
+        self.__offsets.pop(key, None)
+        self.__loaded[key] = item
+
+    def _forget(self, key: str, offset: int) -> None:
+        """
+        Only remember the offset of an (unmodified) entry.
+        """
+        self.__loaded.pop(key, None)
+        self.__offsets[key] = offset
+
+    def _drop(self, key: str) -> None:
+        """
+        Remove an entry.
+        """
+        self.__loaded.pop(key, None)
+        self.__offsets.pop(key, None)
+
+    def get(self, key: str, record: Optional[bytes]=None) -> Item:
+        """
+        Get an entry, loading it if needed.
+
+        The record of the entry can be given if it was already read.
+        """
+        # Not using _resident(), since this is the hot path: subclasses
+        # holding entries differently override get() too.
+        item = self.__loaded.get(key)
+        if item is None:
+            offset = self.__offsets[key]
+            item = self.__store._load(offset, record)
+            item._attach(Link(self, key))
+            self._keep(key, item)
+        return item
 
     def set(self, key: str, value: Item) -> None:
         assert isinstance(key, str)
         assert isinstance(value, Item)
         value._attach(Link(self, key))
-        if value.offset is not None and self.__store is not None and self.__store.volatile:
-            value = (value.offset, weakref(value))
-        self.__entries[key] = value
+        if key not in self.__loaded and key not in self.__offsets:
+            # The sorted keys are updated rather than sorted again.
+            if self.__sorted_keys is not None:
+                insort(self.__sorted_keys, key)
+        self._keep(key, value)
         self._changed()
 
     def remove(self, key: str) -> Item:
         assert isinstance(key, str)
         item = self.get(key)
         item._detach()
-        del self.__entries[key]
+        self._drop(key)
+        sorted_keys = self.__sorted_keys
+        if sorted_keys is not None:
+            del sorted_keys[bisect_left(sorted_keys, key)]
         self._changed()
         return item
 
@@ -400,20 +803,31 @@ class Node(Item):
         return r
 
     def preload(self):
-        for key in self.keys():
-            value = self.get(key)
-            if isinstance(value, Node):
-                value.preload()
+        # Breadth first, so that the entries not loaded yet are read at
+        # once for a whole level of the tree.
+        nodes = [self]
+        while nodes:
+            pending = [(node, key) for node in nodes for key in node.__offsets
+                       if node._resident(key) is None]
+            if pending:
+                # Only loaded nodes have pending entries, from the same
+                # store (this node might be a new one, without store).
+                store = pending[0][0].__store
+                items = store._load_many([node.__offsets[key] for node, key in pending])
+                for (node, key), item in zip(pending, items):
+                    item._attach(Link(node, key))
+                    node._keep(key, item)
+            nodes = [item for node in nodes for item in map(node.get, node.sorted_keys())
+                     if item.KIND is Kind.node]
 
     def _dump(self, printer):
-        if not self.__entries:
+        if not self.__offsets and not self.__loaded:
             printer('ø')
         else:
-            for key, item in sorted(self.__entries.items()):
-                if isinstance(item, tuple):
-                    offset, item = item
-                    if item is not None:
-                        item = item()
+            for key in self.sorted_keys():
+                item = self._resident(key)
+                if item is None:
+                    offset = self.__offsets[key]
                 else:
                     offset = item.offset
                 # FIXME: format_offset()?
@@ -423,10 +837,10 @@ class Node(Item):
                     offset_text = '@{}'.format(offset)
                 if item is None:
                     printer('{} (..{}..);'.format(key, offset_text))
-                elif isinstance(item, Leaf):
+                elif item.KIND is Kind.leaf:
                     printer('{} {};'.format(key, json.dumps(item.value)),
                             '  /* {} */'.format(offset_text))
-                elif isinstance(item, Node):
+                elif item.KIND is Kind.node:
                     printer('{} {{'.format(key),
                             '  /* {} */'.format(offset_text))
                     item._dump(printer.shift(2))
@@ -444,3 +858,56 @@ class Node(Item):
 
     def __repr__(self):
         return 'Node({{{}}})'.format(', '.join('{!r}: ..'.format(key) for key in sorted(self.keys())))
+
+
+class VolatileNode(Node):
+    """
+    A node which doesn't keep its unmodified entries alive.
+
+    Unmodified entries are only weakly referenced, and loaded again
+    from the store if they were collected in the meantime.
+    """
+
+    __slots__ = ['__weak']
+
+    def __init__(self, entries=None, store: Store=None, offset: int=None) -> None:
+        super().__init__(entries, store, offset)
+        self.__weak = WeakValueDictionary()  # type: WeakValueDictionary[str, Item]
+
+    def _persisted(self) -> None:
+        # The entries are persisted too, and can be released.
+        for key in self.keys():
+            item = Node._resident(self, key)
+            if item is not None:
+                self._keep(key, item)
+
+    def get(self, key: str, record: Optional[bytes]=None) -> Item:
+        item = self.__weak.get(key)
+        if item is not None:
+            return item
+        return super().get(key, record)
+
+    def _child_changed(self, key):
+        # A modified entry must be kept alive until it is persisted.
+        item = self._resident(key)
+        if item is not None and item.offset is None:
+            self._keep(key, item)
+        super()._child_changed(key)
+
+    def _resident(self, key: str) -> Optional[Item]:
+        item = super()._resident(key)
+        if item is None:
+            item = self.__weak.get(key)
+        return item
+
+    def _keep(self, key: str, item: Item) -> None:
+        if item.offset is not None:
+            self._forget(key, item.offset)
+            self.__weak[key] = item
+        else:
+            super()._keep(key, item)
+            self.__weak.pop(key, None)
+
+    def _drop(self, key: str) -> None:
+        super()._drop(key)
+        self.__weak.pop(key, None)
@@ -2,34 +2,51 @@
 
 # TODO: .to_json()
 
+import re
 import sys
 import json
+from functools import lru_cache
+from weakref import WeakKeyDictionary
 
-from typing import Any, List, Dict, Optional, Callable, Tuple
-from weakref import WeakValueDictionary
+from typing import Any, List, Dict, FrozenSet, Optional, Callable, Tuple
 from store import Store, Node, Leaf, NullEntryPoint
 
 
+# The ANSI escape sequences for the 16 colors (8 normal, 8 bold).
+_ANSI_PREFIX = ['\033[{};{}m'.format(1 if color >= 8 else 0, 30 + (color % 8)) for color in range(16)]
+_ANSI_BOLD = '\033[1m'
+_ANSI_RESET = '\033[0m'
+
+
 def colored(text, color):
     if color is None:
         return text
     else:
-        return '\033[{};{}m{}\033[0m'.format(1 if color >= 8 else 0, 30 + (color % 8), text)
+        return _ANSI_PREFIX[color] + text + _ANSI_RESET
 
 
 def bold(text, apply=True):
     if not apply:
         return text
     else:
-        return '\033[1m{}\033[0m'.format(text)
+        return _ANSI_BOLD + text + _ANSI_RESET
 
 
-def is_interactive():
-    return hasattr(sys, 'ps1')
+# Escaping of the key names in dumps.
+_QUOTE_TABLE = str.maketrans({'\\': '\\\\', ' ': '\\ ', '.': '\\.', '\n': '\\n'})
+
 
+def quote(name):
+    """
+    >>> print(quote('a b.c\\\\d'))
+    a\\ b\\.c\\\\d
 
-def join_path(a, b):
-    return (a[0], join_path(a[1], b)) if a else b
+    """
+    return name.translate(_QUOTE_TABLE)
+
+
+def is_interactive():
+    return hasattr(sys, 'ps1')
 
 
 def path_unroll(chain):
@@ -82,6 +99,17 @@ class Schema:
         """
         pass
 
+    def validate_many(self, tree, items):
+        """
+        Check if the values of several leaves are valid.
+
+        Args:
+            items -- (list) the (name, value) pairs of the leaves.
+        """
+        validate = self.validate
+        for name, value in items:
+            validate(tree, name, value)
+
     def check(self, tree):
         """
         Check tree consistency before a commit."
@@ -100,6 +128,12 @@ class Schema:
         """
         pass
 
+    def has_extras(self):
+        """
+        Tell if extra() might give any key.
+        """
+        return type(self).extra is not Schema.extra
+
     def pose(self, tree, name: str, value: Any) -> Optional['Tree']:
         """
         Convert a leaf into a tree.
@@ -113,6 +147,14 @@ class Schema:
         # This is useful for auto-completion
         pass
 
+    def fixed_choices(self):
+        """
+        Get the set of possible keys, if it doesn't depend on the tree.
+
+        Returns None otherwise.
+        """
+        return None
+
     def format(self, tree, name):
         """
         Indicates how to format the tree.
@@ -143,6 +185,12 @@ class Schema:
         """
         pass  # set() with missing mandatory keys
 
+    def has_missing(self):
+        """
+        Tell if missing() might give any key.
+        """
+        return type(self).missing is not Schema.missing
+
 
 class Empty:
 
@@ -182,18 +230,103 @@ def conv_name(name):
 
 _NO_ARG = object()
 
+
+# Kinds of query elements.
+QUERY_LITERAL = 0  # type: int
+QUERY_MULTI = 1  # type: int
+QUERY_STAR = 2  # type: int
+QUERY_DSTAR = 3  # type: int
+
+# An element of a query, up to the next '.' (if any). Elements wrapped
+# in parentheses are kept in the result paths.
+_QUERY_ELEMENT = re.compile(r'(?P<keep>\()?(?:\{(?P<multi>[^.]*?)\}|(?P<name>[^.]*?))(?(keep)\))(?:(?P<dot>\.)|\Z)')
+
+
+@lru_cache(maxsize=1024)
+def _compile_query(expr: str) -> Tuple[Tuple[int, Any, bool], ...]:
+    """
+    Compile a query (without ',') into (kind, data, keep) elements.
+
+    `data` is the key for QUERY_LITERAL, and the tuple of keys for
+    QUERY_MULTI.
+    """
+    r = []
+    pos = 0
+    while True:
+        m = _QUERY_ELEMENT.match(expr, pos)
+        keep = m.group('keep') is not None
+        multi = m.group('multi')
+        element = m.group('name')
+        if multi is not None:
+            r.append((QUERY_MULTI, tuple(multi.split(',')), keep))
+        elif element == '*':
+            r.append((QUERY_STAR, None, keep))
+        elif element == '**':
+            r.append((QUERY_DSTAR, None, keep))
+        else:
+            r.append((QUERY_LITERAL, element, keep))
+        if m.group('dot') is None:
+            break
+        pos = m.end()
+    # Without any parenthesized element, everything is kept.
+    if not any(keep for _, _, keep in r):
+        r = [(kind, data, True) for kind, data, _ in r]
+    return tuple(r)
+
+
+# Specialized subclasses of Tree, by schema then by base class (see
+# Tree._specialize). The classes don't refer to their schema, so the
+# entries go away with the schemas.
+_SPECIALIZED = WeakKeyDictionary()  # type: WeakKeyDictionary[Schema, Dict[type, type]]
+
+# Returned for the extra and missing keys of trees whose schema never
+# gives any.
+_EMPTY = frozenset()  # type: FrozenSet[str]
+
+
 class Tree(Nope):
 
-    __slots__ = ['__entries', '__parent', '__name', '__node', '__schema']
+    # The class a specialized class derives from.
+    _base_class = None  # type: Optional[type]
+
+    # Bumped whenever any tree is modified. What a tree memoizes from
+    # its schema (which may look anywhere in the configuration) is only
+    # valid for the generation it was computed in.
+    _generation = 0  # type: int
+
+    __slots__ = ['__entries', '__parent', '__name', '__node', '__schema', '__extra',
+                 '__has_extras', '__has_missing', '__descend_name', '__descend_schema',
+                 '__path', '__parent_path', '__generation']
 
     def __init__(self, *, parent, name, node, schema):
-        super().__init__()
         assert parent is None or name is not None
-        self.__entries = WeakValueDictionary()  # type: ignore
-        self.__parent = parent
-        self.__name = name
-        self.__node = node
-        self.__schema = schema
+        # Trees are built for every visited subtree, and assigning
+        # attributes goes through Tree.__setattr__ (written in Python).
+        # The slots are set through their descriptors instead.
+
+        # The subtrees already built, by name. Entries are removed
+        # explicitly when the corresponding key is set or deleted.
+        Tree.__entries.__set__(self, {})
+        Tree.__parent.__set__(self, parent)
+        Tree.__name.__set__(self, name)
+        Tree.__node.__set__(self, node)
+        Tree.__schema.__set__(self, schema)
+        # The extra keys given by the schema, computed on first use,
+        # and reset when any tree is modified or the schema changes.
+        Tree.__extra.__set__(self, None)
+        # Whether the schema might give extra keys at all.
+        Tree.__has_extras.__set__(self, schema.has_extras())
+        # Whether the schema might report missing keys at all.
+        Tree.__has_missing.__set__(self, schema.has_missing())
+        # The last result of __descend(), reset like __extra.
+        Tree.__descend_name.__set__(self, None)
+        Tree.__descend_schema.__set__(self, None)
+        # The path of this tree, and the path of the parent it was
+        # built from.
+        Tree.__path.__set__(self, None)
+        Tree.__parent_path.__set__(self, None)
+        # The generation of the memos above.
+        Tree.__generation.__set__(self, Tree._generation)
 
     @property
     def _name(self):
@@ -208,13 +341,20 @@ class Tree(Nope):
         return self if self.__parent is None else self.__parent._root
 
     @property
-    def _path(self):
+    def _path(self) -> Tuple[str, ...]:
         if self.__name is None:
             assert self.__parent is None, 'Non root node without name'
-            return []
+            return ()
         else:
             assert self.__parent is not None, 'Root node should not have name'
-            return self.__parent._path + [self.__name]
+            # The path is only rebuilt when the path of the parent is
+            # not the one it was built from, which also covers a tree
+            # moved (or any of its ancestors).
+            parent_path = self.__parent._path
+            if parent_path is not self.__parent_path:
+                self.__path = parent_path + (self.__name,)
+                self.__parent_path = parent_path
+            return self.__path
 
     @property
     def _choices(self):
@@ -228,16 +368,34 @@ class Tree(Nope):
         """
         Transform the tree and leafs into a JSON structure.
         """
-        r = {}
-        for key in self._keys():
-            t, value = self._get(key, raw=True, annotated=True)
-            if t == 'tree':
-                r[key] = value._to_json()
-            elif t == 'leaf':
-                r[key] = value
-            else:
-                pass
-        return r
+        # The nodes are walked directly: only the subtrees are built
+        # (for their schemas), not the leaves. The subtrees built only
+        # for this walk are released once visited, rather than being
+        # kept by their parent.
+        result = {}  # type: Dict[str, Any]
+        stack = [(self, result, False)]
+        while stack:
+            tree, r, temporary = stack.pop()
+            tree.__load()
+            node = tree.__node
+            if node is None:
+                raise KeyError(tree.__name)
+            # Keys shadowed by extra keys are not part of the JSON.
+            extra = tree.__extras() if tree.__has_extras else None
+            entries = tree.__entries
+            for key in node.sorted_keys():
+                if extra and key in extra:
+                    continue
+                n = node.get(key)
+                if isinstance(n, Node):
+                    sub = r[key] = {}
+                    built = key not in entries
+                    stack.append((tree._get(key, raw=True), sub, built))
+                else:
+                    r[key] = n.value
+            if temporary:
+                tree._release()
+        return result
 
     def _keys(self):
         """
@@ -248,10 +406,80 @@ class Tree(Nope):
             raise KeyError(self.__name)
         return self.__node.keys()
 
+    def __extras(self):
+        if self.__generation != Tree._generation:
+            self.__reset()
+        extra = self.__extra
+        if extra is None:
+            extra = self.__extra = self.__schema.extra(self) or {}
+        return extra
+
+    def __descend(self, name):
+        # Single entry memo. Comparing by identity is enough, since the
+        # same key object is usually passed again (a miss only costs a
+        # call to the schema).
+        if self.__generation != Tree._generation:
+            self.__reset()
+        if name is not self.__descend_name:
+            schema = self.__schema.descend(self, name)
+            self.__descend_name = name
+            self.__descend_schema = schema
+        return self.__descend_schema
+
+    def __set_schema(self, schema):
+        self.__schema = schema
+        self.__has_extras = schema.has_extras()
+        self.__has_missing = schema.has_missing()
+        self.__reset()
+        # The properties of a specialized class belong to the previous
+        # schema.
+        if self._base_class is not None:
+            self.__class__ = self._base_class
+
+    def _specialize(self) -> None:
+        """
+        Switch to a subclass with a property for each known key.
+
+        Such keys are then accessed as attributes without going
+        through __getattr__ (which is only called once the regular
+        lookup failed). Only done for schemas with fixed choices. The
+        subclass is shared by all the trees with the same schema.
+        """
+        schema = self.__schema
+        choices = schema.fixed_choices()
+        if choices is None:
+            return
+        base = self._base_class or type(self)
+        classes = _SPECIALIZED.get(schema)
+        if classes is None:
+            classes = _SPECIALIZED[schema] = {}
+        cls = classes.get(base)
+        if cls is None:
+            ns = {'__slots__': (), '_base_class': base}
+            for name in choices:
+                # Keys prefixed by '_' are not accessible as attributes.
+                if name.isidentifier() and not name.startswith('_') and not hasattr(base, name):
+                    ns[name] = property(lambda self, name=name: self._get(name))
+            cls = classes[base] = type(base.__name__, (base,), ns)
+        if type(self) is not cls:
+            self.__class__ = cls
+
+    def __reset(self):
+        """
+        Forget what was computed from the schema for this tree.
+        """
+        self.__extra = None
+        self.__descend_name = None
+        self.__generation = Tree._generation
+
     def _extra_keys(self):
-        return set(self.__schema.extra(self) or ())
+        if not self.__has_extras:
+            return _EMPTY
+        return set(self.__extras())
 
     def _missing_keys(self):
+        if not self.__has_missing:
+            return _EMPTY
         return self.__schema.missing(self) or set()
 
     # FIXME: Maybe raw=True should be the default.
@@ -261,9 +489,10 @@ class Tree(Nope):
         def resolve(o):
             return o() if callable(o) else o
         if name not in self.__entries:
-            extra = self.__schema.extra(self)
-            if extra and name in extra:
-                return resolve(extra[name]) if not annotated else ('extra', resolve(extra[name]))
+            if self.__has_extras:
+                extra = self.__extras()
+                if name in extra:
+                    return resolve(extra[name]) if not annotated else ('extra', resolve(extra[name]))
             if self.__node is not None:
                 if not isinstance(self.__node, Node):
                     raise ValueError('Expected a node for {!r}'.format(self.__name))
@@ -283,19 +512,21 @@ class Tree(Nope):
                         fail = True
                         result = None
                     if isinstance(result, Tree) or fail:
+                        # References also carry the raw value of the
+                        # leaf when annotated.
                         if not annotated:
                             return result
                         elif fail:
-                            return ('badref', result)
+                            return ('badref', result, node.value)
                         else:
-                            return ('ref', result)
+                            return ('ref', result, node.value)
                 if not annotated:
                     return node.value
                 else:
                     return ('leaf', node.value)
             if default is not _NO_ARG:
                 return default
-            schema = self.__schema.descend(self, name)
+            schema = self.__descend(name)
             val = Tree(parent=self, name=name, node=node, schema=schema)
             self.__entries[name] = val
         if not annotated:
@@ -303,17 +534,65 @@ class Tree(Nope):
         else:
             return ('tree', self.__entries[name])
 
+    def _iter_annotated(self):
+        """
+        Iterate over the keys, extra keys included, in order.
+
+        Yields (key, annotated value) pairs, where the annotated value is
+        what _get(key, annotated=True) returns. The leaves are handled
+        in the same pass over the node.
+        """
+        self.__load()
+        node = self.__node
+        if node is None:
+            raise KeyError(self.__name)
+        entries = self.__entries
+        extra = self.__extras() if self.__has_extras else None
+        if extra:
+            keys = sorted(node.keys() | extra.keys())
+        else:
+            keys = node.sorted_keys()
+        pose = self.__schema.pose
+        for key in keys:
+            if key in entries or (extra and key in extra):
+                yield key, self._get(key, annotated=True)
+                continue
+            item = node.get(key)
+            if isinstance(item, Leaf):
+                value = item.value
+                result = pose(self, key, value)
+                if isinstance(result, Tree):
+                    yield key, ('ref', result, value)
+                else:
+                    yield key, ('leaf', value)
+            else:
+                yield key, self._get(key, annotated=True)
+
     def _del(self, name: str) -> None:
         assert isinstance(name, str), \
             'The key must be a string (not {!r})'.format(name)
         if self.__node is not None:
             self.__node.remove(name)
+        self.__entries.pop(name, None)
+        Tree._generation += 1
 
     def _clear(self):
         self.__load()
         for k in self.__node.keys():
             self._del(k)
 
+    def _release(self) -> None:
+        """
+        Drop this tree from the subtrees kept by its parent.
+
+        Subtrees are kept alive by their parent until the key is set or
+        deleted. Once released, this tree (and the subtrees it keeps)
+        can be freed. Accessing the key again builds a new tree.
+        """
+        parent = self.__parent
+        if parent is not None and parent.__entries.get(self.__name) is self:
+            del parent.__entries[self.__name]
+
     @property
     def _help(self):
         print(self.__schema.full_help(self) or 'No help available.')
@@ -328,6 +607,7 @@ class Tree(Nope):
         assert isinstance(name, str), \
             'The key must be a string (not {!r})'.format(name)
         setup = False
+        Tree._generation += 1
         if isinstance(value, Move):
             # Reparenting
             # BUG: Need to apply correct schema recursively.
@@ -342,6 +622,7 @@ class Tree(Nope):
                 p = p.__parent
             self.__realize()
             n = v.__parent.__node.remove(v.__name)
+            v.__parent.__entries.pop(v.__name, None)
             self.__patch(name, v)
             self.__node.set(name, n)
             # FIXME: What are the implications of the following line?
@@ -356,6 +637,7 @@ class Tree(Nope):
             self.__realize()
             self.__patch(name, value)
             self.__node.set(name, n)
+            self.__entries.pop(name, None)
         else:
             if isinstance(value, Empty):
                 value = Node()
@@ -365,41 +647,88 @@ class Tree(Nope):
                 value = Leaf(value)
             self.__realize()
             self.__node.set(name, value)
+            self.__entries.pop(name, None)
+        # Memos computed while setting the value are outdated too.
+        Tree._generation += 1
         # if setup:
         #     self.__schema.setup(self)
 
+    def __subtrees(self):
+        """
+        Iterate over this tree and all its subtrees, parents first.
+
+        The subtrees of a tree are only looked up once the iteration
+        resumes, so that the caller can update the tree meanwhile. The
+        subtrees built only for the iteration are released afterward.
+        """
+        stack = [(self, False)]
+        while stack:
+            tree, temporary = stack.pop()
+            tree.__realize()
+            yield tree
+            node = tree.__node
+            entries = tree.__entries
+            # Reversed, to visit the keys in order. The sorted keys
+            # are maintained by the node, so no sort happens here.
+            for k in reversed(node.sorted_keys()):
+                # Leaves are skipped without building anything.
+                if isinstance(node.get(k), Node):
+                    built = k not in entries
+                    # An extra key may shadow the subtree.
+                    v = tree._get(k, raw=True)
+                    if isinstance(v, Tree):
+                        stack.append((v, built))
+            if temporary:
+                tree._release()
+
     def __check(self, schema):
-        self.__realize()
-        for k in sorted(self.__node.keys()):
-            v = self._get(k)
-            if not isinstance(v, Tree):
-                schema.validate(self, k, v)
-            else:
-                v.__check(schema.descend(self, k))
+        # The subtrees built only for the check are released once
+        # checked, like in __subtrees.
+        stack = [(self, schema, False)]
+        while stack:
+            tree, schema, temporary = stack.pop()
+            tree.__realize()
+            node = tree.__node
+            entries = tree.__entries
+            subtrees = []
+            leaves = []
+            for k in node.sorted_keys():
+                n = node.get(k)
+                if isinstance(n, Node):
+                    built = k not in entries
+                    v = tree._get(k, raw=True)
+                    if isinstance(v, Tree):
+                        subtrees.append((v, tree.__descend(k) if schema is tree.__schema else schema.descend(tree, k),
+                                         built))
+                    else:
+                        # Shadowed by an extra key.
+                        leaves.append((k, v))
+                else:
+                    leaves.append((k, n.value))
+            if leaves:
+                schema.validate_many(tree, leaves)
+            stack += reversed(subtrees)
+            if temporary:
+                tree._release()
 
     def __precheck(self, name, value):
         assert isinstance(value, Tree)
-        schema = self.__schema.descend(self, name)
+        schema = self.__descend(name)
         value.__check(schema=schema)
 
     def __rec_patch(self):
-        self.__realize()
-        for k in sorted(self.__node.keys()):
-            v = self._get(k)
-            if isinstance(v, Tree):
-                self.__patch(k, v)
+        for tree in self.__subtrees():
+            if tree is not self:
+                parent = tree.__parent
+                tree.__set_schema(parent.__descend(tree.__name))
 
     def __patch(self, name, value):
-        value.__schema = self.__schema.descend(self, name)
+        value.__set_schema(self.__descend(name))
         value.__rec_patch()
 
     def __commit_check(self):
-        self.__schema.check(self)
-        self.__realize()
-        for k in sorted(self.__node.keys()):
-            v = self._get(k, raw=True)
-            if isinstance(v, Tree):
-                v.__commit_check()
+        for tree in self.__subtrees():
+            tree.__schema.check(tree)
 
     def _check(self):
         self.__commit_check()
@@ -420,6 +749,7 @@ class Tree(Nope):
             self.__parent.__realize()
             self.__node = self.__parent.__node.node(self.__name, created_cb)
             if created:
+                Tree._generation += 1
                 self._setup()
 
     def _setup(self):
@@ -440,6 +770,10 @@ class Tree(Nope):
     def __getattr__(self, name):
         if name.startswith('_'):
             raise RuntimeError("Use tree['_key'] for accessing keys prefixed by _")
+        # Specialized on first use, so that the next accesses to the
+        # keys of the schema skip __getattr__.
+        if self._base_class is None:
+            self._specialize()
         return self._get(conv_name(name))
 
     def __setattr__(self, name, value):
@@ -454,34 +788,33 @@ class Tree(Nope):
         self._del(conv_name(name))
 
     # FIXME: query in extra too?
-    def __query(self, qpath: List[str]) -> List[Tuple[Any, Any]]:
+    def __query(self, qpath: Tuple[Tuple[int, Any, bool], ...], prefix=None) -> List[Tuple[Any, Any]]:
+        # The paths of the results are built as they go (see
+        # path_unroll), starting from `prefix`, the path to this tree.
         if not qpath:
             return {}
         self.__realize()
-        r = [(None, self)]  # type: List[Tuple[Any, Any]]
+        r = [(prefix, self)]  # type: List[Tuple[Any, Any]]
         f = []
-        for i, (element, keep) in enumerate(qpath):
+        for i, (kind, data, keep) in enumerate(qpath):
             s = []  # type: List[Tuple[Any, Any]]
             for k, v in r:
                 if not isinstance(v, Tree):
                     pass
-                elif element in ('*', '**'):
+                elif kind == QUERY_STAR or kind == QUERY_DSTAR:
                     # FIXME: We might want to include extra keys too
                     # (perhaps only if matching the final term of the
                     # query)
                     for key in v.__node.keys():
                         vv = v._get(key)
-                        if element != '**':
+                        if kind == QUERY_STAR:
                             s.append(((key, k) if keep else k, vv))
                         elif isinstance(vv, Tree):
-                            f += [(join_path(kk, (key, k)) if keep else join_path(kk, k), e) for kk, e in vv.__query(qpath[i:])]
-                    if element == '**':
-                        f += v.__query(qpath[i+1:])
+                            f += vv.__query(qpath[i:], (key, k) if keep else k)
+                    if kind == QUERY_DSTAR:
+                        f += v.__query(qpath[i+1:], k)
                 else:
-                    if element.startswith('{') and element.endswith('}'):
-                        keys = element[1:-1].split(',')
-                    else:
-                        keys = [element]
+                    keys = data if kind == QUERY_MULTI else (data,)
                     for key in keys:
                         if key in v.__node.keys():
                             s.append(((key, k) if keep else k, v._get(key)))
@@ -497,13 +830,7 @@ class Tree(Nope):
             if len(a) + len(b) != len(r):
                 raise RuntimeError('Name ellision conflict (multi-exprs)')
             return r
-        path = expr.split('.')
-        qpath = [(el, el.startswith('(') and el.endswith(')')) for el in path]
-        if not any(item[1] for item in qpath):
-            qpath = [(el, True) for el, keep in qpath]
-        else:
-            qpath = [(el[1:-1] if keep else el, keep) for el, keep in qpath]
-        r = self.__query(qpath)
+        r = self.__query(_compile_query(expr))
         if transform is None:
             transform = lambda o: o
         if filter is None:
@@ -536,18 +863,20 @@ class Tree(Nope):
 
     # FIXME: Pass name_prefix as a list?
     # FIXME: Rewrite this function
-    def __dump(self, prefix, name_prefix, show_help, color, expand, depth_limit, flat):
+    def __dump_into(self, out, prefix, name_prefix, show_help, color, expand, depth_limit, flat):
         bottom = (depth_limit <= 0) if depth_limit is not None else False
         next_depth_limit = depth_limit - 1 if depth_limit is not None else None
-        r = []
-        extra = self.__schema.extra(self) or {}
-        ks = self._keys() | extra.keys()
-        def quote(n):
-            return n.replace('\\', '\\\\').replace(' ', '\\ ').replace('.', '\\.').replace('\n', '\\n')
-        if not ks:
-            r.append('{}ø'.format(prefix))
+        extra = self.__extras()
+        items = list(self._iter_annotated())
+        brace_color = 3 if color else None
+        ref_color = 2 if color else None
+        arrow_color = 10 if color else None
+        extra_color = 2 if color else None
+        extra_mark_color = 10 if color else None
+        if not items:
+            out.append('{}ø'.format(prefix))
         else:
-            for k in sorted(ks):
+            for k, v in items:
                 if name_prefix is not None:
                     nk = '{}{}{}'.format(colored(name_prefix, 12 if color else None), ' ' if not flat else '.', quote(k))
                 else:
@@ -564,66 +893,68 @@ class Tree(Nope):
                                 h.append('##')
                         h.append('##')
                         if color:
-                            r += ['{}{}'.format(prefix, colored(line, 8))
-                                  for line in h]
+                            out += ['{}{}'.format(prefix, colored(line, 8))
+                                    for line in h]
                         else:
-                            r += ['{}{}'.format(prefix, line)
-                                  for line in h]
-                v = self._get(k, annotated=True)
+                            out += ['{}{}'.format(prefix, line)
+                                    for line in h]
                 if v[0] == 'tree' or (v[0] == 'extra' and isinstance(v[1], Tree)):
-                    c1 = 3 if color else None
-                    c2 = 2 if color else None
-                    c3 = 10 if color else None
+                    c1 = brace_color
+                    c2 = ref_color
+                    c3 = arrow_color
                     if not expand and (flat or self.__schema.format(self, k) == 'arg') and (not isinstance(v[1], Tree) or v[1]._keys() or v[1]._extra_keys()):
                         if bottom:
-                            r.append('{}{} {}..{}'.format(prefix, nk, colored('{', c1), colored('}', c1)))
+                            out.append('{}{} {}..{}'.format(prefix, nk, colored('{', c1), colored('}', c1)))
                         else:
-                            r += v[1].__dump(prefix, nk, show_help, color, expand, next_depth_limit, flat)
+                            v[1].__dump_into(out, prefix, nk, show_help, color, expand, next_depth_limit, flat)
                     else:
                         if bottom:
-                            r.append('{}{} {}..{}'.format(prefix, nk, colored('{', c1), colored('}', c1)))
+                            out.append('{}{} {}..{}'.format(prefix, nk, colored('{', c1), colored('}', c1)))
                         else:
                             if v[0] == 'tree' and not v[1]._keys() and not v[1]._extra_keys() and not v[1]._missing_keys():
                                 if not flat:
-                                    r.append('{}{} {} ø {}'.format(prefix, nk, colored('{', c1), colored('}', c1)))
+                                    out.append('{}{} {} ø {}'.format(prefix, nk, colored('{', c1), colored('}', c1)))
                             else:
                                 if v[0] == 'tree':
-                                    r.append('{}{} {}'.format(prefix, nk, colored('{', c1)))
+                                    out.append('{}{} {}'.format(prefix, nk, colored('{', c1)))
                                 else:
-                                    r.append('{}{} {} {} {}'.format(prefix, colored(nk, c2), colored('=>', c3), colored('{', c1), colored('# ref:{}'.format('.'.join(map(quote, v[1]._path))), 7 if color else None)))
-                                r += v[1].__dump(prefix + '  ', None, show_help, color, expand, next_depth_limit, flat)
-                                r.append('{}{}'.format(prefix, colored('}', c1)))
+                                    out.append('{}{} {} {} {}'.format(prefix, colored(nk, c2), colored('=>', c3), colored('{', c1), colored('# ref:{}'.format('.'.join(map(quote, v[1]._path))), 7 if color else None)))
+                                v[1].__dump_into(out, prefix + '  ', None, show_help, color, expand, next_depth_limit, flat)
+                                out.append('{}{}'.format(prefix, colored('}', c1)))
                 elif v[0] == 'leaf':
-                    r.append('{}{} {};'.format(prefix, nk, bold(json.dumps(v[1]), color)))
+                    out.append('{}{} {};'.format(prefix, nk, bold(json.dumps(v[1]), color)))
                 elif v[0] in ('ref', 'badref'):
                     bad = (v[0] == 'badref')
                     text = '{}{}{}'.format(colored('@(', (13 if not bad else 9) if color else None),
-                                           colored(json.dumps(self._get(k, raw=True)), (5 if not bad else 1) if color else None),
+                                           colored(json.dumps(v[2]), (5 if not bad else 1) if color else None),
                                            colored(')', (13 if not bad else 9) if color else None))
-                    r.append('{}{} {}; {}'.format(prefix, nk, text, colored('# ref:{}'.format('.'.join(v[1]._path)), 7 if color else None)))
+                    out.append('{}{} {}; {}'.format(prefix, nk, text, colored('# ref:{}'.format('.'.join(v[1]._path)), 7 if color else None)))
                 elif v[0] == 'extra':
-                    c1 = 2 if color else None
-                    c2 = 10 if color else None
+                    c1 = extra_color
+                    c2 = extra_mark_color
                     if not flat:
                         text = '{}{}{}'.format(colored('<', c2),
                                                colored(json.dumps(v[1]), c1),
                                                colored('>', c2))
                     else:
                         text = colored(json.dumps(v[1]), c1)
-                    r.append('{}{} {};'.format(prefix, colored(nk, c1), text))
+                    out.append('{}{} {};'.format(prefix, colored(nk, c1), text))
                 else:
                     raise RuntimeError('Unexpected tag ({!r})'.format(v[0]))
         for name in sorted(self._missing_keys()):
             text = '/* {}: missing mandatory key {!r} */'.format('Warning' if not color else colored('Warning', 1), name)
-            r.append('{}{}'.format(prefix, text))
-        return r
+            out.append('{}{}'.format(prefix, text))
 
     def _dump(self, *, help: bool=False, color: bool=False, expand: bool=False, depth: int=None, flat: bool=False) -> None:
-        print('\n'.join(self.__dump('', None, help, color, expand, depth, flat)))
+        out = []  # type: List[str]
+        self.__dump_into(out, '', None, help, color, expand, depth, flat)
+        print('\n'.join(out))
 
     def __repr__(self):
         if is_interactive():
-            return '\n'.join(self.__dump('', None, False, True, False, None, False))
+            out = []  # type: List[str]
+            self.__dump_into(out, '', None, False, True, False, None, False)
+            return '\n'.join(out)
         else:
             return '{}{}({!r})'.format(self.__class__.__name__,
                                        '[{}]'.format(self.__node.offset
@@ -10,10 +10,16 @@ class Printer:
         self.__output = output
 
     def __call__(self, line: str, misc: Optional[str]=None) -> None:
-        r = self.__prefix + line
         if misc:
-            r = '{:<20}{}'.format(r, misc)
-        self.__output(r)
+            self.__output('{:<20}{}'.format(self.__prefix + line, misc))
+        else:
+            self.__output(self.__prefix + line)
+
+    def plain(self, line: str) -> None:
+        """
+        Print a line without the misc column.
+        """
+        self.__output(self.__prefix + line)
 
     def shift(self, amount: int) -> 'Printer':
         return Printer(self.__prefix + ' ' * amount, self.__output)